@@ -0,0 +1,336 @@
+import asyncio
+import base64
+import io
+import os
+import struct
+import time
+import zlib
+
+from PIL import Image, GifImagePlugin
+from pyppeteer import launch
+
+from config import settings
+from exceptions import InvalidAnimationParameters
+import tracing
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# Флаги рендера PNG, которые для pyppeteer задаются через launch и setViewport
+SCREENSHOT_ONLY_FLAGS = (
+    '--headless',
+    '--window-size',
+    '--force-device-scale-factor',
+    '--screenshot-clip',
+)
+
+# Без этих флагов кадры не следуют виртуальному времени
+ANIMATION_FLAGS = [
+    '--run-all-compositor-stages-before-draw',
+    # transform/opacity анимации иначе идут в потоке композитора по реальным часам
+    '--disable-threaded-animation',
+]
+
+
+class GifWriter:
+    """Потоковая запись GIF: каждый кадр кодируется сразу с локальной палитрой"""
+    def __init__(self, fp, fps, loop=0):
+        self.fp = fp
+        self.fps = fps
+        self.loop = loop
+        self.size = None
+        self.frames = 0
+        self._elapsed_cs = 0
+
+    def add_frame(self, frame):
+        frame = frame.convert("RGB").quantize(colors=256)
+        if self.size is None:
+            self.size = frame.size
+            header, _ = GifImagePlugin.getheader(frame, info={"loop": self.loop})
+            for chunk in header:
+                self.fp.write(chunk)
+        elif frame.size != self.size:
+            raise ValueError(f"Размер кадра {frame.size} не совпадает с {self.size}")
+
+        # Задержка GIF в сотых долях секунды: копим ошибку округления
+        self.frames += 1
+        target_cs = round(self.frames * 100 / self.fps)
+        delay_cs = target_cs - self._elapsed_cs
+        self._elapsed_cs = target_cs
+
+        for chunk in GifImagePlugin.getdata(frame, duration=delay_cs * 10, include_color_table=True):
+            self.fp.write(chunk)
+
+    def close(self):
+        self.fp.write(b";")
+
+
+class ApngWriter:
+    """Потоковая запись APNG: IDAT каждого кадра сразу пишется как fdAT"""
+    def __init__(self, fp, fps, frame_count, loop=0):
+        self.fp = fp
+        self.fps = fps
+        self.frame_count = frame_count
+        self.loop = loop
+        self.size = None
+        self.frames = 0
+        self._sequence = 0
+
+    def add_frame(self, frame):
+        frame = frame.convert("RGBA")
+        buffer = io.BytesIO()
+        frame.save(buffer, "PNG", compress_level=6)
+        chunks = list(_iter_png_chunks(buffer.getvalue()))
+
+        if self.size is None:
+            self.size = frame.size
+            self.fp.write(PNG_SIGNATURE)
+            self._write_chunk(b"IHDR", next(data for name, data in chunks if name == b"IHDR"))
+            self._write_chunk(b"acTL", struct.pack(">II", self.frame_count, self.loop))
+        elif frame.size != self.size:
+            raise ValueError(f"Размер кадра {frame.size} не совпадает с {self.size}")
+
+        # Задержка кадра ровно 1/fps секунды, без наложения на предыдущий кадр
+        self._write_chunk(b"fcTL", struct.pack(
+            ">IIIIIHHBB",
+            self._next_sequence(), self.size[0], self.size[1], 0, 0, 1, self.fps, 0, 0
+        ))
+        for name, data in chunks:
+            if name != b"IDAT":
+                continue
+            if self.frames == 0:
+                self._write_chunk(b"IDAT", data)
+            else:
+                self._write_chunk(b"fdAT", struct.pack(">I", self._next_sequence()) + data)
+        self.frames += 1
+
+    def close(self):
+        if self.frames != self.frame_count:
+            raise ValueError(f"Записано {self.frames} кадров из {self.frame_count}")
+        self._write_chunk(b"IEND", b"")
+
+    def _next_sequence(self):
+        sequence = self._sequence
+        self._sequence += 1
+        return sequence
+
+    def _write_chunk(self, name, data):
+        self.fp.write(struct.pack(">I", len(data)) + name + data)
+        self.fp.write(struct.pack(">I", zlib.crc32(name + data) & 0xffffffff))
+
+
+class WebpWriter:
+    """Потоковая запись анимированного WebP: каждый кадр сразу пишется в ANMF"""
+    def __init__(self, fp, fps, loop=0, quality=80):
+        self.fp = fp
+        self.fps = fps
+        self.loop = loop
+        self.quality = quality
+        self.size = None
+        self.frames = 0
+        self._elapsed_ms = 0
+        self._start = None
+
+    def add_frame(self, frame):
+        frame = frame.convert("RGBA")
+        if self.size is None:
+            self.size = frame.size
+            self._write_header()
+        elif frame.size != self.size:
+            raise ValueError(f"Размер кадра {frame.size} не совпадает с {self.size}")
+
+        buffer = io.BytesIO()
+        frame.save(buffer, "WEBP", quality=self.quality)
+        bitstream = b"".join(
+            _riff_chunk(name, data)
+            for name, data in _iter_riff_chunks(buffer.getvalue())
+            if name in (b"ALPH", b"VP8 ", b"VP8L")
+        )
+
+        # Длительность кадра в миллисекундах: копим ошибку округления
+        self.frames += 1
+        target_ms = round(self.frames * 1000 / self.fps)
+        duration_ms = target_ms - self._elapsed_ms
+        self._elapsed_ms = target_ms
+
+        header = (
+            _uint24(0) + _uint24(0)
+            + _uint24(self.size[0] - 1) + _uint24(self.size[1] - 1)
+            + _uint24(duration_ms)
+            + bytes([0x02])  # без смешивания с предыдущим кадром
+        )
+        self.fp.write(_riff_chunk(b"ANMF", header + bitstream))
+
+    def close(self):
+        # Размер RIFF известен только в конце, дописываем его в заголовок
+        end = self.fp.tell()
+        self.fp.seek(self._start + 4)
+        self.fp.write(struct.pack("<I", end - self._start - 8))
+        self.fp.seek(end)
+
+    def _write_header(self):
+        self._start = self.fp.tell()
+        self.fp.write(b"RIFF" + struct.pack("<I", 0) + b"WEBP")
+        vp8x_flags = 0x10 | 0x02  # alpha + animation
+        self.fp.write(_riff_chunk(
+            b"VP8X",
+            bytes([vp8x_flags, 0, 0, 0]) + _uint24(self.size[0] - 1) + _uint24(self.size[1] - 1)
+        ))
+        self.fp.write(_riff_chunk(b"ANIM", bytes(4) + struct.pack("<H", self.loop)))
+
+
+ANIMATION_FORMATS = {
+    "gif": "image/gif",
+    "apng": "image/apng",
+    "webp": "image/webp",
+}
+
+
+def _iter_png_chunks(data):
+    position = len(PNG_SIGNATURE)
+    while position < len(data):
+        length, name = struct.unpack(">I4s", data[position:position + 8])
+        yield name, data[position + 8:position + 8 + length]
+        position += 12 + length
+
+
+def _iter_riff_chunks(data):
+    position = 12  # RIFF + размер + WEBP
+    while position < len(data):
+        name = data[position:position + 4]
+        length, = struct.unpack("<I", data[position + 4:position + 8])
+        yield name, data[position + 8:position + 8 + length]
+        position += 8 + length + (length & 1)
+
+
+def _riff_chunk(name, data):
+    return name + struct.pack("<I", len(data)) + data + (b"\0" if len(data) & 1 else b"")
+
+
+def _uint24(value):
+    return struct.pack("<I", value)[:3]
+
+
+def animation_flags(chromium_flags):
+    """Флаги рендера PNG эндпоинта, дополненные флагами покадрового захвата"""
+    flags = [flag for flag in chromium_flags if not flag.startswith(SCREENSHOT_ONLY_FLAGS)]
+    return flags + [flag for flag in ANIMATION_FLAGS if flag not in flags]
+
+
+def create_writer(animation, fp, fps, frame_count):
+    if animation == "gif":
+        return GifWriter(fp, fps)
+    if animation == "apng":
+        return ApngWriter(fp, fps, frame_count)
+    return WebpWriter(fp, fps)
+
+
+def validate_animation(animation, fps, duration):
+    """Проверяет параметры анимации и возвращает количество кадров"""
+    if animation not in ANIMATION_FORMATS:
+        raise InvalidAnimationParameters(
+            f"Неизвестный формат анимации. Допустимые значения: {', '.join(ANIMATION_FORMATS)}"
+        )
+    if not 1 <= fps <= settings.animation_max_fps:
+        raise InvalidAnimationParameters(
+            f"Частота кадров должна быть от 1 до {settings.animation_max_fps}"
+        )
+    if not 0 < duration <= settings.animation_max_duration:
+        raise InvalidAnimationParameters(
+            f"Длительность анимации должна быть от 0 до {settings.animation_max_duration} секунд"
+        )
+
+    frame_count = max(1, round(fps * duration))
+    if frame_count > settings.animation_max_frames:
+        raise InvalidAnimationParameters(
+            f"Слишком много кадров ({frame_count}), максимум {settings.animation_max_frames}"
+        )
+    return frame_count
+
+
+async def render_animation(html_content, output_path, animation, fps, frame_count, viewport, clip,
+                           chromium_flags, stage):
+    """
+    Загружает страницу один раз и снимает кадры в той же вкладке,
+    продвигая виртуальное время на 1/fps секунды между кадрами.
+    Кадры кодируются сразу после захвата, в памяти держится только текущий.
+    """
+    temp_html = f"{output_path}.html"
+    with open(temp_html, 'w', encoding='utf-8') as f:
+        f.write(html_content)
+
+    browser = None
+    try:
+        with tracing.span("chromium.launch"):
+            browser = await launch(
+                executablePath=settings.chromium_path,
+                args=animation_flags(chromium_flags) + tracing.chrome_trace_flags(stage),
+                handleSIGINT=False,
+                handleSIGTERM=False,
+                handleSIGHUP=False
+            )
+
+        with tracing.span("page.load"):
+            page = await browser.newPage()
+            await page.setViewport(viewport)
+            await page.goto(f'file://{temp_html}', waitUntil='load', timeout=settings.http_timeout * 1000)
+            await page.evaluate("() => document.fonts.ready.then(() => true)")
+            animations_count = await page.evaluate("() => document.getAnimations().length")
+
+        # Без анимаций все кадры одинаковые, не тратим на них время
+        if not animations_count:
+            raise InvalidAnimationParameters("На странице нет CSS-анимаций")
+
+        with tracing.span("animation.capture", format=animation, fps=fps, frames=frame_count) as span:
+            session = await page.target.createCDPSession()
+            # Перематываем CSS-анимации к началу и останавливаем виртуальное время
+            await page.evaluate("() => document.getAnimations().forEach(a => { a.currentTime = 0; })")
+            await session.send('Emulation.setVirtualTimePolicy', {'policy': 'pause'})
+
+            # Декодирование и кодирование кадра уходят в пул потоков, чтобы не блокировать
+            # event loop; следующий кадр снимается только после записи предыдущего
+            loop = asyncio.get_event_loop()
+            capture_time = 0.0
+            encode_time = 0.0
+            with open(output_path, 'wb') as fp:
+                writer = create_writer(animation, fp, fps, frame_count)
+                for index in range(frame_count):
+                    started = time.perf_counter()
+                    if index:
+                        await _advance_virtual_time(session, 1000 / fps)
+                    frame_data = await _capture_frame(session, clip)
+                    captured = time.perf_counter()
+                    await loop.run_in_executor(None, _encode_frame, writer, frame_data)
+                    encode_time += time.perf_counter() - captured
+                    capture_time += captured - started
+                await loop.run_in_executor(None, writer.close)
+
+            span.set_attribute("animation.capture_ms", round(capture_time * 1000))
+            span.set_attribute("animation.encode_ms", round(encode_time * 1000))
+            span.set_attribute("animation.bytes", os.path.getsize(output_path))
+    finally:
+        if browser is not None:
+            await browser.close()
+        if os.path.exists(temp_html):
+            os.remove(temp_html)
+
+
+async def _advance_virtual_time(session, budget_ms):
+    expired = asyncio.get_event_loop().create_future()
+
+    def on_expired(*args):
+        if not expired.done():
+            expired.set_result(True)
+
+    session.once('Emulation.virtualTimeBudgetExpired', on_expired)
+    await session.send('Emulation.setVirtualTimePolicy', {'policy': 'advance', 'budget': budget_ms})
+    await asyncio.wait_for(expired, timeout=settings.http_timeout)
+
+
+async def _capture_frame(session, clip):
+    result = await session.send('Page.captureScreenshot', {'format': 'png', 'clip': clip})
+    return result['data']
+
+
+def _encode_frame(writer, frame_data):
+    with Image.open(io.BytesIO(base64.b64decode(frame_data))) as frame:
+        writer.add_frame(frame)
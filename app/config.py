@@ -27,6 +27,27 @@ class Settings(BaseSettings):
     # Таймаут ожидания в очереди (в секундах)
     wait_timeout: int = 60
     
+    # Трассировка запросов
+    trace_enabled: bool = True
+    trace_service_name: str = "html-to-image"
+    trace_export_path: str = ""      # JSONL-файл для trace, пусто - не писать
+    trace_collector_url: str = ""    # OTLP/HTTP коллектор, например http://otel-collector:4318/v1/traces
+    trace_slow_threshold_ms: int = 5000  # Порог для лога медленных запросов
+    trace_export_queue_size: int = 2048  # Trace сверх лимита отбрасываются
+    trace_export_batch_size: int = 64
+    trace_export_interval: float = 1.0   # Секунды ожидания до отправки неполной пачки
+    trace_export_shutdown_timeout: float = 5.0  # Сколько ждать экспорта при остановке
+    
+    # Debug-профилирование отдельных запросов (заголовок X-Debug-Trace: 1)
+    trace_debug_enabled: bool = False
+    trace_debug_dir: str = "/app/temp/traces"
+    
+    # Анимированные изображения (GIF / APNG / WebP)
+    chromium_path: str = "/usr/bin/chromium"
+    animation_max_fps: int = 30
+    animation_max_duration: float = 10.0  # Секунды
+    animation_max_frames: int = 150
+    
     class Config:
         env_file = ".env"
 
@@ -37,4 +37,15 @@ class ImageProcessingError(ImageConverterException):
                 "message": detail,
                 "error_type": "processing_error"
             }
-        ) 
\ No newline at end of file
+        )
+
+class InvalidAnimationParameters(ImageConverterException):
+    """Некорректные параметры анимации"""
+    def __init__(self, detail: str):
+        super().__init__(
+            status_code=400,
+            detail={
+                "message": detail,
+                "error_type": "invalid_animation"
+            }
+        )
\ No newline at end of file
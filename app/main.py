@@ -3,6 +3,7 @@ from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.responses import JSONResponse, FileResponse, Response
+from starlette.background import BackgroundTask
 from fastapi.exceptions import RequestValidationError
 from html2image import Html2Image
 import os
@@ -26,7 +27,10 @@ from redis import Redis
 from redis.exceptions import RedisError
 import time
 import asyncio
+from typing import Optional
 from exceptions import UserRateLimitExceeded, SystemOverloadedException, ImageProcessingError, ImageConverterException
+import tracing
+from animation import ANIMATION_FORMATS, validate_animation, render_animation
 
 # Базовая настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -145,7 +149,8 @@ class GlobalRateLimitMiddleware(BaseHTTPMiddleware):
 
     async def dispatch(self, request: Request, call_next):
         try:
-            await self.limiter.check_limit()
+            with tracing.span("queue.wait"):
+                await self.limiter.check_limit()
             response = await call_next(request)
             return response
         except SystemOverloadedException as exc:
@@ -160,6 +165,34 @@ class GlobalRateLimitMiddleware(BaseHTTPMiddleware):
 # Добавляем middleware
 app.add_middleware(GlobalRateLimitMiddleware)
 
+# Middleware трассировки: должен быть внешним, чтобы учитывать ожидание в очереди
+class TracingMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request: Request, call_next):
+        request_id = tracing.new_request_id(request.headers.get(tracing.REQUEST_ID_HEADER))
+        request.state.request_id = request_id
+        debug = request.headers.get(tracing.DEBUG_HEADER) == "1"
+
+        with tracing.request_trace(
+            f"{request.method} {request.url.path}",
+            request_id,
+            debug=debug,
+            **{"http.method": request.method, "http.target": request.url.path}
+        ) as root:
+            response = await call_next(request)
+            root.set_attribute("http.status_code", response.status_code)
+            if response.status_code >= 500:
+                root.set_error(f"HTTP {response.status_code}")
+
+        response.headers[tracing.REQUEST_ID_HEADER] = request_id
+        return response
+
+app.add_middleware(TracingMiddleware)
+
+@app.on_event("shutdown")
+def shutdown_tracing():
+    # Дописываем trace, накопленные в очереди экспорта
+    tracing.shutdown()
+
 # Перемещаем все обработчики исключений в одно место
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request: Request, exc: RequestValidationError):
@@ -200,20 +233,27 @@ async def rate_limit_exceeded_handler(request: Request, exc: RateLimitExceeded):
 
 @app.exception_handler(Exception)
 async def general_exception_handler(request: Request, exc: Exception):
-    logger.error(f"Неожиданная ошибка: {str(exc)}")
+    request_id = getattr(request.state, "request_id", None)
+    logger.error(f"Неожиданная ошибка [{request_id}]: {str(exc)}", exc_info=exc)
     return JSONResponse(
         status_code=500,
-        content={"message": "Произошла внутренняя ошибка сервера. Попробуйте позже."}
+        content={
+            "message": "Произошла внутренняя ошибка сервера. Попробуйте позже.",
+            "request_id": request_id
+        }
     )
 
 def download_and_encode_image(url):
     try:
         logger.info(f"Загрузка изображения: {url}")
-        response = requests.get(url, timeout=settings.http_timeout, verify=settings.verify_ssl)
-        response.raise_for_status()
-        image_content = response.content
-        encoded = base64.b64encode(image_content).decode('utf-8')
-        content_type = response.headers.get('content-type', 'image/png')
+        with tracing.span("asset.download", url=url) as span:
+            response = requests.get(url, timeout=settings.http_timeout, verify=settings.verify_ssl)
+            response.raise_for_status()
+            image_content = response.content
+            encoded = base64.b64encode(image_content).decode('utf-8')
+            content_type = response.headers.get('content-type', 'image/png')
+            span.set_attribute("asset.bytes", len(image_content))
+            span.set_attribute("asset.content_type", content_type)
         result = f"data:{content_type};base64,{encoded}"
         logger.info(f"Изображение успешно загружено и закод��ровано: {url}")
         return result
@@ -284,6 +324,86 @@ def create_screenshot_with_selenium(html_content, output_path):
         if os.path.exists(temp_html):
             os.remove(temp_html)
 
+# Флаги Chromium для /convert; анимация использует их же, чтобы текст растрировался одинаково
+CONVERT_CHROMIUM_FLAGS = [
+    '--no-sandbox',
+    '--disable-gpu',
+    '--disable-dev-shm-usage',
+    '--headless',
+    '--hide-scrollbars',
+    '--force-device-scale-factor=2',
+    '--window-size=1920,1080',
+    '--font-render-hinting=medium',
+    '--disable-setuid-sandbox',
+    '--no-first-run',
+    '--no-default-browser-check',
+    '--disable-extensions',
+    '--log-level=3',  # FATAL
+    '--silent',
+    '--disable-logging',
+    '--disable-ipc-flooding-protection',
+    '--disable-notifications'
+]
+
+# Флаги Chromium для /render-card
+CARD_CHROMIUM_FLAGS = [
+    '--no-sandbox',
+    '--disable-gpu',
+    '--headless',
+    '--hide-scrollbars',
+    '--lang=ru',
+    '--font-render-hinting=none',
+    '--disable-font-subpixel-positioning',
+    '--force-device-scale-factor=1',
+    '--window-size=1920,1500',
+    '--disable-setuid-sandbox',
+    '--disable-software-rasterizer',
+    '--disable-dev-shm-usage',
+    '--ignore-certificate-errors',
+    '--disable-web-security',
+    '--allow-file-access-from-files',
+    '--disable-background-timer-throttling',
+    '--disable-backgrounding-occluded-windows',
+    '--disable-renderer-backgrounding',
+    '--run-all-compositor-stages-before-draw',
+    '--screenshot-clip=0,0,1920,1500',
+    '--hide-scrollbars',
+    '--force-device-scale-factor=1',
+    '--log-level=3',  # FATAL
+    '--silent',
+    '--disable-logging',
+    '--disable-extensions',
+    '--disable-ipc-flooding-protection',
+    '--disable-notifications'
+]
+
+async def render_animated_response(html_content, animation, fps, frame_count, viewport, clip, chromium_flags, stage):
+    """Рендерит анимацию во временный файл и отдает его потоком, файл удаляется после отправки"""
+    filename = f"{stage}_{uuid.uuid4()}.{animation}"
+    full_path = os.path.join(settings.temp_dir, filename)
+    try:
+        await render_animation(
+            html_content,
+            full_path,
+            animation,
+            fps,
+            frame_count,
+            viewport=viewport,
+            clip=clip,
+            chromium_flags=chromium_flags,
+            stage=stage
+        )
+    except BaseException:
+        if os.path.exists(full_path):
+            os.remove(full_path)
+        raise
+
+    return FileResponse(
+        full_path,
+        media_type=ANIMATION_FORMATS[animation],
+        background=BackgroundTask(os.remove, full_path)
+    )
+
 @app.post("/convert", 
     response_class=FileResponse,
     summary="Конвертировать HTML файл в изображение",
@@ -293,13 +413,23 @@ async def convert_html_to_image(
     request: Request,
     html_file: UploadFile = File(...),
     width: int = Form(...),
-    height: int = Form(...)
+    height: int = Form(...),
+    animation: Optional[str] = Form(None),
+    fps: int = Form(10),
+    duration: float = Form(2.0)
 ):
+    frame_count = validate_animation(animation, fps, duration) if animation else None
+
     full_path = None
     try:
-        content = await html_file.read()
-        detected = chardet.detect(content)
-        encoding = detected['encoding']
+        with tracing.span("html.read") as span:
+            content = await html_file.read()
+            span.set_attribute("html.bytes", len(content))
+
+        with tracing.span("chardet.detect") as span:
+            detected = chardet.detect(content)
+            encoding = detected['encoding']
+            span.set_attribute("html.encoding", str(encoding))
         
         try:
             html_content = content.decode(encoding)
@@ -312,29 +442,6 @@ async def convert_html_to_image(
                     detail="Не удалось правильно прочитать файл. Убедитесь, что файл в кодировке UTF-8 или Windows-1251"
                 )
 
-        hti = Html2Image(
-            output_path=settings.temp_dir,
-            custom_flags=[
-                '--no-sandbox',
-                '--disable-gpu',
-                '--disable-dev-shm-usage',
-                '--headless',
-                '--hide-scrollbars',
-                '--force-device-scale-factor=2',
-                '--window-size=1920,1080',
-                '--font-render-hinting=medium',
-                '--disable-setuid-sandbox',
-                '--no-first-run',
-                '--no-default-browser-check',
-                '--disable-extensions',
-                '--log-level=3',  # FATAL
-                '--silent',
-                '--disable-logging',
-                '--disable-ipc-flooding-protection',
-                '--disable-notifications'
-            ]
-        )
-        
         # Извлекаем стили из HTML
         style_pattern = r'<style[^>]*>(.*?)</style>'
         html_styles = ' '.join(re.findall(style_pattern, html_content, re.DOTALL))
@@ -367,27 +474,47 @@ async def convert_html_to_image(
         """
         
         # Удляем теги style из HTML, так как стили будут переданы отдельно
-        processed_html = re.sub(style_pattern, '', process_html_with_images(html_content))
-        
-        filename = f"image_{uuid.uuid4()}.png"
-        full_path = os.path.join(settings.temp_dir, filename)
+        with tracing.span("assets.fetch"):
+            processed_html = re.sub(style_pattern, '', process_html_with_images(html_content))
         
         # Удаляем проверку и чтение внешнего CSS файла
         css_content = base_styles + html_styles
         
-        hti.screenshot(
-            html_str=processed_html,
-            css_str=css_content,
-            save_as=filename,
-            size=(width, height)
+        if animation:
+            # Та же область, что и при обрезке PNG до 1920x1080 при масштабе 2
+            return await render_animated_response(
+                f"<style>{css_content}</style>{processed_html}",
+                animation,
+                fps,
+                frame_count,
+                viewport={'width': width, 'height': height, 'deviceScaleFactor': 2},
+                clip={'x': 0, 'y': 0, 'width': min(width, 960), 'height': min(height, 540), 'scale': 1},
+                chromium_flags=CONVERT_CHROMIUM_FLAGS,
+                stage="convert_animation"
+            )
+        
+        hti = Html2Image(
+            output_path=settings.temp_dir,
+            custom_flags=CONVERT_CHROMIUM_FLAGS + tracing.chrome_trace_flags("convert")
         )
         
+        filename = f"image_{uuid.uuid4()}.png"
+        full_path = os.path.join(settings.temp_dir, filename)
+        
+        with tracing.span("chromium.render", width=width, height=height):
+            hti.screenshot(
+                html_str=processed_html,
+                css_str=css_content,
+                save_as=filename,
+                size=(width, height)
+            )
+        
         if not os.path.exists(full_path):
             raise ImageProcessingError("Не удалось создать изображение")
             
         # Добавляем обработку и обрезку изображения
         try:
-            with Image.open(full_path) as img:
+            with tracing.span("image.png_encode"), Image.open(full_path) as img:
                 # Обрезаем нижние 420 пикселей
                 cropped_img = img.crop((0, 0, 1920, 1080))  # 1500 - 420 = 1080
                 # Сохраняем обрезанное изображение
@@ -412,7 +539,7 @@ async def convert_html_to_image(
     except ImageConverterException:
         raise
     except Exception as e:
-        logger.error(f"Неожиданная ошибка: {str(e)}")
+        logger.exception(f"Неожиданная ошибка [{tracing.current_request_id()}]: {str(e)}")
         raise ImageProcessingError("Произошла внутренняя ошибка сервера")
 
 @app.get("/render-card", response_class=FileResponse)
@@ -421,8 +548,13 @@ async def render_card(
     name: str,
     text: str,
     vjuh: str = "https://cdek25.ru/cards/v1.png",
-    bg: str = "https://cdek25.ru/cards/1.png"
+    bg: str = "https://cdek25.ru/cards/1.png",
+    animation: Optional[str] = None,
+    fps: int = 10,
+    duration: float = 2.0
 ):
+    frame_count = validate_animation(animation, fps, duration) if animation else None
+
     # Проверяем и устанавливаем дефолтные значения для изображений
     if not bg.startswith("https://cdek25.ru/cards/"):
         bg = "https://cdek25.ru/cards/1.png"
@@ -440,23 +572,24 @@ async def render_card(
     full_path = None
     try:
         template_path = os.path.join(settings.static_dir, 'index.html')
-        with open(template_path, 'r', encoding='utf-8') as f:
+        with tracing.span("template.load"), open(template_path, 'r', encoding='utf-8') as f:
             html_content = f.read()
         
         try:
             # Загружаем изображения
             logger.info("Начало загрузки изображений")
-            try:
-                bg_data = download_and_encode_image(bg)
-            except:
-                logger.warning(f"Не удалось загрузить фоновое изображение {bg}, использую дефолтное")
-                bg_data = download_and_encode_image("https://cdek25.ru/cards/1.png")
-            
-            try:
-                vjuh_data = download_and_encode_image(vjuh)
-            except:
-                logger.warning(f"Не удалось загрузить вжух {vjuh}, использую дефолтный")
-                vjuh_data = download_and_encode_image("https://cdek25.ru/cards/v1.png")
+            with tracing.span("assets.fetch"):
+                try:
+                    bg_data = download_and_encode_image(bg)
+                except:
+                    logger.warning(f"Не удалось загрузить фоновое изображение {bg}, использую дефолтное")
+                    bg_data = download_and_encode_image("https://cdek25.ru/cards/1.png")
+                
+                try:
+                    vjuh_data = download_and_encode_image(vjuh)
+                except:
+                    logger.warning(f"Не удалось загрузить вжух {vjuh}, использую дефолтный")
+                    vjuh_data = download_and_encode_image("https://cdek25.ru/cards/v1.png")
                 
             logger.info("Изображения успешно загружены")
             
@@ -470,44 +603,9 @@ async def render_card(
             logger.error(f"Ошибка при обработке изображений: {str(e)}")
             raise
         except Exception as e:
-            logger.error(f"Неожиданная ошибка при обработке изображений: {str(e)}")
+            logger.exception(f"Неожиданная ошибка при обработке изображений [{tracing.current_request_id()}]: {str(e)}")
             raise ImageProcessingError("Ошибка при обработке изображений")
 
-        # Обновляем настройки для Html2Image
-        hti = Html2Image(
-            output_path=settings.static_dir,
-            custom_flags=[
-                '--no-sandbox',
-                '--disable-gpu',
-                '--headless',
-                '--hide-scrollbars',
-                '--lang=ru',
-                '--font-render-hinting=none',
-                '--disable-font-subpixel-positioning',
-                '--force-device-scale-factor=1',
-                '--window-size=1920,1500',
-                '--disable-setuid-sandbox',
-                '--disable-software-rasterizer',
-                '--disable-dev-shm-usage',
-                '--ignore-certificate-errors',
-                '--disable-web-security',
-                '--allow-file-access-from-files',
-                '--disable-background-timer-throttling',
-                '--disable-backgrounding-occluded-windows',
-                '--disable-renderer-backgrounding',
-                '--run-all-compositor-stages-before-draw',
-                '--screenshot-clip=0,0,1920,1500',
-                '--hide-scrollbars',
-                '--force-device-scale-factor=1',
-                '--log-level=3',  # FATAL
-                '--silent',
-                '--disable-logging',
-                '--disable-extensions',
-                '--disable-ipc-flooding-protection',
-                '--disable-notifications'
-            ]
-        )
-        
         # Заменяем относительные пути на абсолютные для шрифтов
         html_content = html_content.replace(
             "url('/fonts/",
@@ -562,21 +660,40 @@ async def render_card(
             '''
         )
         
+        if animation:
+            return await render_animated_response(
+                html_content,
+                animation,
+                fps,
+                frame_count,
+                viewport={'width': 1920, 'height': 1500, 'deviceScaleFactor': 1},
+                clip={'x': 0, 'y': 0, 'width': 1920, 'height': 1080, 'scale': 1},
+                chromium_flags=CARD_CHROMIUM_FLAGS,
+                stage="render_card_animation"
+            )
+        
+        # Обновляем настройки для Html2Image
+        hti = Html2Image(
+            output_path=settings.static_dir,
+            custom_flags=CARD_CHROMIUM_FLAGS + tracing.chrome_trace_flags("render_card")
+        )
+        
         filename = f"card_{uuid.uuid4()}.png"
         full_path = os.path.join(settings.static_dir, filename)
         
-        hti.screenshot(
-            html_str=html_content,
-            save_as=filename,
-            size=(1920, 1500)
-        )
+        with tracing.span("chromium.render", width=1920, height=1500):
+            hti.screenshot(
+                html_str=html_content,
+                save_as=filename,
+                size=(1920, 1500)
+            )
         
         if not os.path.exists(full_path):
             raise ImageProcessingError("Не удалось создать карточку")
             
         # Добавляем обработку и обрезку изображ��ния
         try:
-            with Image.open(full_path) as img:
+            with tracing.span("image.png_encode"), Image.open(full_path) as img:
                 # Обрезаем нижние 420 пикселей
                 cropped_img = img.crop((0, 0, 1920, 1080))  # 1500 - 420 = 1080
                 # Сохраняем обрезанное изображение
@@ -601,5 +718,5 @@ async def render_card(
     except ImageConverterException:
         raise
     except Exception as e:
-        logger.error(f"Неожиданная ошибка: {str(e)}")
+        logger.exception(f"Неожиданная ошибка [{tracing.current_request_id()}]: {str(e)}")
         raise ImageProcessingError("Произошла внутренняя ошибка сервера")
@@ -0,0 +1,399 @@
+import contextvars
+import cProfile
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+import traceback
+import uuid
+from contextlib import contextmanager
+
+import requests
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+REQUEST_ID_HEADER = "X-Request-ID"
+DEBUG_HEADER = "X-Debug-Trace"
+
+# Категории Chromium trace, достаточные для разбора layout / paint / raster
+CHROME_TRACE_CATEGORIES = (
+    "devtools.timeline,blink,cc,gpu,loading,"
+    "disabled-by-default-devtools.timeline"
+)
+
+# OTLP: SPAN_KIND_INTERNAL / SPAN_KIND_SERVER, STATUS_CODE_OK / STATUS_CODE_ERROR
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+_request_id_pattern = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+_current_span = contextvars.ContextVar("current_span", default=None)
+_export_queue = None
+_export_done = None
+_export_queue_lock = threading.Lock()
+# Метка в очереди экспорта: после нее экспортер дописывает пачку и завершается
+_SHUTDOWN = object()
+_dropped_traces = 0
+# cProfile видит весь поток event loop, поэтому профилируем не больше одного запроса сразу
+_profiler_lock = threading.Lock()
+
+
+class Span:
+    """Участок трассировки запроса (аналог span в OpenTelemetry)"""
+    def __init__(self, trace, name, parent_id=None, kind=SPAN_KIND_INTERNAL, attributes=None):
+        self.trace = trace
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = dict(attributes or {})
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def set_error(self, message):
+        self.error = message
+
+    def record_exception(self, exc):
+        self.error = f"{type(exc).__name__}: {exc}"
+        self.attributes["exception.type"] = type(exc).__name__
+        self.attributes["exception.message"] = str(exc)
+        self.attributes["exception.stacktrace"] = ''.join(
+            traceback.format_exception(type(exc), exc, exc.__traceback__)
+        )
+
+    def end(self):
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+
+    @property
+    def duration_ms(self):
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def to_otlp(self):
+        result = {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns or time.time_ns()),
+            "attributes": _otlp_attributes(self.attributes),
+            "status": {"code": STATUS_ERROR, "message": self.error} if self.error else {"code": STATUS_OK},
+        }
+        if self.parent_id:
+            result["parentSpanId"] = self.parent_id
+        return result
+
+
+class _NoopSpan:
+    """Заглушка, когда трассировка выключена или запрос вне контекста"""
+    def set_attribute(self, key, value):
+        pass
+
+    def set_error(self, message):
+        pass
+
+    def record_exception(self, exc):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class Trace:
+    """Все участки одного запроса, объединенные request_id"""
+    def __init__(self, request_id, debug=False):
+        self.request_id = request_id
+        self.trace_id = uuid.uuid4().hex
+        self.debug = debug
+        self.spans = []
+
+
+def new_request_id(incoming=None):
+    """Берем request_id клиента, если он корректный, иначе генерируем новый"""
+    if incoming and _request_id_pattern.match(incoming):
+        return incoming
+    return uuid.uuid4().hex
+
+
+def current_request_id():
+    trace = _current_trace.get()
+    return trace.request_id if trace else None
+
+
+@contextmanager
+def span(name, **attributes):
+    """Замеряет этап обработки запроса как дочерний span текущего"""
+    trace = _current_trace.get()
+    if trace is None:
+        yield _NOOP_SPAN
+        return
+
+    parent = _current_span.get()
+    current = Span(trace, name, parent.span_id if parent else None, attributes=attributes)
+    trace.spans.append(current)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as exc:
+        current.record_exception(exc)
+        raise
+    finally:
+        current.end()
+        _current_span.reset(token)
+
+
+@contextmanager
+def request_trace(name, request_id, debug=False, **attributes):
+    """Корневой span запроса: экспорт, лог медленных запросов и debug-профиль"""
+    if not settings.trace_enabled:
+        yield _NOOP_SPAN
+        return
+
+    trace = Trace(request_id, debug=debug and settings.trace_debug_enabled)
+    root = Span(trace, name, kind=SPAN_KIND_SERVER, attributes=attributes)
+    root.set_attribute("request.id", request_id)
+    trace.spans.append(root)
+    trace_token = _current_trace.set(trace)
+    span_token = _current_span.set(root)
+
+    profiler = _start_profiler(trace) if trace.debug else None
+    try:
+        yield root
+    except BaseException as exc:
+        root.record_exception(exc)
+        raise
+    finally:
+        root.end()
+        if profiler is not None:
+            _stop_profiler(trace, root, profiler)
+        _current_span.reset(span_token)
+        _current_trace.reset(trace_token)
+        _log_if_slow(trace, root)
+        export_trace(trace)
+
+
+def chrome_trace_flags(stage):
+    """Флаги Chromium для записи performance trace (только в debug-режиме)"""
+    trace = _current_trace.get()
+    if trace is None or not trace.debug:
+        return []
+
+    trace_path = _debug_path(trace, f"{stage}.chrome.json")
+    if trace_path is None:
+        return []
+    current = _current_span.get()
+    if current is not None:
+        current.set_attribute("debug.chrome_trace", trace_path)
+    return [
+        f'--trace-startup={CHROME_TRACE_CATEGORIES}',
+        f'--trace-startup-file={trace_path}',
+        '--trace-startup-format=json',
+        '--trace-startup-duration=0',
+    ]
+
+
+def export_trace(trace):
+    """Ставит trace в очередь фонового экспортера; при переполнении trace отбрасывается"""
+    global _dropped_traces
+    if not settings.trace_export_path and not settings.trace_collector_url:
+        return
+
+    try:
+        _get_export_queue().put_nowait(_otlp_payload(trace))
+    except queue.Full:
+        _dropped_traces += 1
+        if _dropped_traces % 100 == 1:
+            logger.warning(f"Очередь экспорта trace переполнена, отброшено: {_dropped_traces}")
+
+
+def shutdown(timeout=None):
+    """Дописывает накопленные trace при остановке воркера; False, если не успели"""
+    global _export_queue, _export_done
+    if timeout is None:
+        timeout = settings.trace_export_shutdown_timeout
+
+    with _export_queue_lock:
+        export_queue, done = _export_queue, _export_done
+        _export_queue = _export_done = None
+    if export_queue is None:
+        return True
+
+    deadline = time.monotonic() + timeout
+    try:
+        export_queue.put(_SHUTDOWN, timeout=timeout)
+    except queue.Full:
+        logger.warning("Не удалось дождаться экспорта trace: очередь переполнена")
+        return False
+    if not done.wait(max(0, deadline - time.monotonic())):
+        logger.warning(f"Экспорт trace не завершился за {timeout} с")
+        return False
+    return True
+
+
+def _get_export_queue():
+    # Поток создается лениво, уже после форка воркеров uvicorn
+    global _export_queue, _export_done
+    with _export_queue_lock:
+        if _export_queue is None:
+            _export_queue = queue.Queue(maxsize=settings.trace_export_queue_size)
+            _export_done = threading.Event()
+            threading.Thread(
+                target=_export_worker,
+                args=(_export_queue, _export_done),
+                name="trace-exporter",
+                daemon=True
+            ).start()
+    return _export_queue
+
+
+def _export_worker(export_queue, done):
+    """Фоновый экспорт пачками, по аналогии с BatchSpanProcessor из OpenTelemetry"""
+    stopping = False
+    while not stopping:
+        batch = []
+        item = export_queue.get()
+        if item is _SHUTDOWN:
+            stopping = True
+        else:
+            batch.append(item)
+
+        deadline = time.monotonic() + settings.trace_export_interval
+        while not stopping and len(batch) < settings.trace_export_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = export_queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is _SHUTDOWN:
+                stopping = True
+            else:
+                batch.append(item)
+
+        if batch and settings.trace_export_path:
+            _write_to_file(batch)
+        if batch and settings.trace_collector_url:
+            _send_to_collector(batch)
+    done.set()
+
+
+def _write_to_file(batch):
+    try:
+        with open(settings.trace_export_path, 'a', encoding='utf-8') as f:
+            for payload in batch:
+                f.write(json.dumps(payload, ensure_ascii=False) + '\n')
+    except Exception as e:
+        logger.error(f"Не удалось записать {len(batch)} trace: {str(e)}")
+
+
+def _send_to_collector(batch):
+    # Все trace пачки отправляются одним запросом с общим resource
+    payload = {"resourceSpans": [
+        resource_spans
+        for item in batch
+        for resource_spans in item["resourceSpans"]
+    ]}
+    try:
+        response = requests.post(
+            settings.trace_collector_url,
+            json=payload,
+            timeout=settings.http_timeout
+        )
+        response.raise_for_status()
+    except Exception as e:
+        logger.error(f"Не удалось отправить {len(batch)} trace в коллектор: {str(e)}")
+
+
+def _start_profiler(trace):
+    if not _profiler_lock.acquire(blocking=False):
+        logger.warning(f"Профилирование запроса {trace.request_id} пропущено: уже идет другое")
+        return None
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as e:
+        # В процессе уже работает другой профилировщик
+        _profiler_lock.release()
+        logger.warning(f"Профилирование запроса {trace.request_id} недоступно: {str(e)}")
+        return None
+    return profiler
+
+
+def _stop_profiler(trace, root, profiler):
+    try:
+        profiler.disable()
+        profile_path = _debug_path(trace, "prof")
+        if profile_path is not None:
+            profiler.dump_stats(profile_path)
+            root.set_attribute("debug.python_profile", profile_path)
+    except Exception as e:
+        logger.error(f"Не удалось сохранить профиль запроса {trace.request_id}: {str(e)}")
+    finally:
+        _profiler_lock.release()
+
+
+def _debug_path(trace, suffix):
+    # Имя по trace_id: X-Request-ID задает клиент, он может повторяться
+    try:
+        os.makedirs(settings.trace_debug_dir, exist_ok=True)
+    except OSError as e:
+        logger.error(f"Не удалось создать {settings.trace_debug_dir}: {str(e)}")
+        return None
+    return os.path.join(settings.trace_debug_dir, f"{trace.trace_id}.{suffix}")
+
+
+def _log_if_slow(trace, root):
+    if root.duration_ms < settings.trace_slow_threshold_ms:
+        return
+    stages = ', '.join(
+        f"{s.name}={s.duration_ms:.0f}ms"
+        for s in trace.spans
+        if s.parent_id == root.span_id
+    )
+    logger.warning(
+        f"Медленный запрос {trace.request_id} ({root.name}): "
+        f"{root.duration_ms:.0f}ms [{stages}]"
+    )
+
+
+def _otlp_payload(trace):
+    return {
+        "resourceSpans": [{
+            "resource": {
+                "attributes": _otlp_attributes({"service.name": settings.trace_service_name})
+            },
+            "scopeSpans": [{
+                "scope": {"name": "html-to-image"},
+                "spans": [s.to_otlp() for s in trace.spans]
+            }]
+        }]
+    }
+
+
+def _otlp_attributes(attributes):
+    result = []
+    for key, value in attributes.items():
+        if isinstance(value, bool):
+            typed = {"boolValue": value}
+        elif isinstance(value, int):
+            typed = {"intValue": str(value)}
+        elif isinstance(value, float):
+            typed = {"doubleValue": value}
+        else:
+            typed = {"stringValue": str(value)}
+        result.append({"key": key, "value": typed})
+    return result
@@ -0,0 +1,32 @@
+import os
+import sys
+
+import pytest
+
+# Модули приложения импортируются как в контейнере: из директории app
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
+
+# Обязательные настройки без значений по умолчанию
+os.environ.setdefault("TEMP_DIR", "/tmp")
+os.environ.setdefault("STATIC_DIR", os.path.join(os.path.dirname(__file__), '..', 'static'))
+os.environ.setdefault("ALLOWED_ORIGINS", "*")
+os.environ.setdefault("MAX_UPLOAD_SIZE", "10485760")
+os.environ.setdefault("HTTP_TIMEOUT", "10")
+os.environ.setdefault("VERIFY_SSL", "False")
+os.environ.setdefault("ALLOWED_METHODS", "GET,POST")
+os.environ.setdefault("ALLOWED_HEADERS", "*")
+os.environ.setdefault("ALLOW_CREDENTIALS", "True")
+
+
+@pytest.fixture
+def client(monkeypatch):
+    from fastapi.testclient import TestClient
+    import main
+
+    async def no_limit(self):
+        pass
+
+    # Redis в тестах не нужен
+    monkeypatch.setattr(main.GlobalRateLimiter, "check_limit", no_limit)
+    monkeypatch.setattr(main.GlobalRateLimiter, "release", no_limit)
+    return TestClient(main.app)
@@ -0,0 +1,175 @@
+import asyncio
+import io
+import math
+import os
+
+import pytest
+from PIL import Image, ImageDraw
+
+from animation import ANIMATION_FLAGS, animation_flags, create_writer, render_animation, validate_animation
+from config import settings
+from exceptions import InvalidAnimationParameters
+
+SIZE = (64, 48)
+
+
+def make_frame(index):
+    frame = Image.new("RGBA", SIZE, (0, 0, 0, 0))
+    ImageDraw.Draw(frame).rectangle((index * 10, 0, index * 10 + 9, SIZE[1] - 1), fill=(255, 0, 0, 255))
+    return frame
+
+
+def red_columns(frame):
+    frame = frame.convert("RGBA")
+    y = frame.size[1] // 2
+    return [x for x in range(frame.size[0]) if frame.getpixel((x, y))[0] > 200 and frame.getpixel((x, y))[3] > 200]
+
+
+@pytest.mark.parametrize("animation,image_format", [
+    ("gif", "GIF"),
+    ("apng", "PNG"),
+    ("webp", "WEBP"),
+])
+def test_writer_round_trip(animation, image_format):
+    buffer = io.BytesIO()
+    writer = create_writer(animation, buffer, 10, 5)
+    for index in range(5):
+        writer.add_frame(make_frame(index))
+    writer.close()
+
+    buffer.seek(0)
+    with Image.open(buffer) as image:
+        assert image.format == image_format
+        assert image.size == SIZE
+        assert image.n_frames == 5
+        for index in range(5):
+            image.seek(index)
+            image.load()
+            assert round(image.info["duration"]) == 100
+            assert red_columns(image)[0] == index * 10
+
+
+def test_apng_rejects_missing_frames():
+    writer = create_writer("apng", io.BytesIO(), 10, 3)
+    writer.add_frame(make_frame(0))
+    with pytest.raises(ValueError):
+        writer.close()
+
+
+def test_validate_animation_frame_count():
+    assert validate_animation("webp", 10, 2.0) == 20
+    assert validate_animation("gif", 1, 0.1) == 1
+
+
+@pytest.mark.parametrize("animation,fps,duration", [
+    ("bogus", 10, 2.0),
+    ("gif", 0, 2.0),
+    ("gif", settings.animation_max_fps + 1, 2.0),
+    ("gif", 10, 0),
+    ("gif", 10, -1.0),
+    ("gif", 10, math.nan),
+    ("gif", 10, settings.animation_max_duration + 1),
+])
+def test_validate_animation_rejects(animation, fps, duration):
+    with pytest.raises(InvalidAnimationParameters) as error:
+        validate_animation(animation, fps, duration)
+    assert error.value.status_code == 400
+
+
+def test_validate_animation_rejects_too_many_frames(monkeypatch):
+    monkeypatch.setattr(settings, "animation_max_frames", 19)
+    with pytest.raises(InvalidAnimationParameters):
+        validate_animation("apng", 10, 2.0)
+
+
+def test_animation_flags_keep_endpoint_rendering():
+    flags = animation_flags([
+        '--no-sandbox',
+        '--headless',
+        '--font-render-hinting=medium',
+        '--force-device-scale-factor=2',
+        '--window-size=1920,1080',
+        '--screenshot-clip=0,0,1920,1500',
+        '--run-all-compositor-stages-before-draw',
+    ])
+    assert flags[:2] == ['--no-sandbox', '--font-render-hinting=medium']
+    assert not any(flag.startswith(('--headless', '--window-size', '--force-device', '--screenshot-clip')) for flag in flags)
+    assert sorted(set(flags) & set(ANIMATION_FLAGS)) == sorted(ANIMATION_FLAGS)
+    assert len(flags) == len(set(flags))
+
+
+def test_render_card_rejects_bad_animation_before_fetch(client, monkeypatch):
+    import main
+
+    def fetch(url):
+        raise AssertionError("изображения не должны загружаться")
+
+    monkeypatch.setattr(main, "download_and_encode_image", fetch)
+    response = client.get("/render-card", params={"name": "Имя", "text": "Текст", "animation": "bogus"})
+
+    assert response.status_code == 400
+    assert response.json()["error_type"] == "invalid_animation"
+
+
+def test_render_card_streams_animation_file(client, monkeypatch):
+    import main
+
+    rendered = {}
+
+    async def fake_render(html_content, output_path, animation, fps, frame_count, **kwargs):
+        rendered.update(kwargs, path=output_path, frame_count=frame_count)
+        with open(output_path, 'wb') as f:
+            f.write(b"GIF89a-frames")
+
+    monkeypatch.setattr(main, "download_and_encode_image", lambda url: "data:image/png;base64,")
+    monkeypatch.setattr(main, "render_animation", fake_render)
+    response = client.get("/render-card", params={
+        "name": "Имя", "text": "Текст", "animation": "gif", "fps": 5, "duration": 1
+    })
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/gif"
+    assert response.content == b"GIF89a-frames"
+    assert rendered["frame_count"] == 5
+    assert rendered["chromium_flags"] is main.CARD_CHROMIUM_FLAGS
+    # Файл удаляется фоновой задачей после отправки
+    assert not os.path.exists(rendered["path"])
+
+
+@pytest.mark.skipif(not os.path.exists(settings.chromium_path), reason="Chromium не установлен")
+def test_render_animation_follows_virtual_time(tmp_path):
+    # transform-анимация на отдельном слое: 100px за 1 секунду
+    html = """
+    <style>
+        html, body { margin: 0; background: #fff; }
+        #box {
+            position: absolute; top: 0; left: 0; width: 10px; height: 40px;
+            background: #f00; transform: translateZ(0);
+            animation: move 1s linear forwards;
+        }
+        @keyframes move {
+            from { transform: translateX(0); }
+            to { transform: translateX(100px); }
+        }
+    </style>
+    <div id="box"></div>
+    """
+    output_path = str(tmp_path / "box.apng")
+    asyncio.run(render_animation(
+        html,
+        output_path,
+        "apng",
+        10,
+        6,
+        viewport={'width': 200, 'height': 40, 'deviceScaleFactor': 1},
+        clip={'x': 0, 'y': 0, 'width': 200, 'height': 40, 'scale': 1},
+        chromium_flags=['--no-sandbox', '--disable-gpu', '--headless'],
+        stage="test"
+    ))
+
+    with Image.open(output_path) as image:
+        assert image.n_frames == 6
+        for index in range(6):
+            image.seek(index)
+            image.load()
+            assert abs(red_columns(image)[0] - index * 10) <= 2
@@ -0,0 +1,140 @@
+import json
+import queue
+
+import pytest
+
+import tracing
+from config import settings
+
+
+@pytest.fixture
+def exported(monkeypatch):
+    traces = []
+    monkeypatch.setattr(tracing, "export_trace", traces.append)
+    return traces
+
+
+def attributes(span):
+    return {item["key"]: item["value"] for item in span["attributes"]}
+
+
+def test_new_request_id_keeps_valid_client_id():
+    assert tracing.new_request_id("client-42.a_b") == "client-42.a_b"
+
+
+@pytest.mark.parametrize("incoming", [None, "", "bad id!", "x" * 65])
+def test_new_request_id_replaces_invalid_id(incoming):
+    request_id = tracing.new_request_id(incoming)
+    assert request_id != incoming
+    assert len(request_id) == 32
+
+
+def test_nested_span_has_parent(exported):
+    with tracing.request_trace("GET /test", "rid") as root:
+        with tracing.span("outer") as outer:
+            with tracing.span("inner") as inner:
+                pass
+
+    spans = {span["name"]: span for span in (s.to_otlp() for s in exported[0].spans)}
+    assert "parentSpanId" not in spans["GET /test"]
+    assert spans["outer"]["parentSpanId"] == root.span_id
+    assert spans["inner"]["parentSpanId"] == outer.span_id
+    assert spans["inner"]["traceId"] == spans["GET /test"]["traceId"]
+    assert inner.end_ns is not None
+
+
+def test_span_outside_request_is_noop():
+    with tracing.span("orphan") as span:
+        span.set_attribute("key", "value")
+    assert tracing.current_request_id() is None
+
+
+def test_otlp_attributes_types():
+    result = {
+        item["key"]: item["value"]
+        for item in tracing._otlp_attributes({
+            "flag": True,
+            "count": 3,
+            "ratio": 0.5,
+            "name": "card",
+        })
+    }
+    assert result["flag"] == {"boolValue": True}
+    assert result["count"] == {"intValue": "3"}
+    assert result["ratio"] == {"doubleValue": 0.5}
+    assert result["name"] == {"stringValue": "card"}
+
+
+def test_recorded_exception_sets_error_status(exported):
+    with pytest.raises(ValueError):
+        with tracing.request_trace("GET /test", "rid"):
+            with tracing.span("stage"):
+                raise ValueError("boom")
+
+    for span in exported[0].spans:
+        otlp = span.to_otlp()
+        assert otlp["status"]["code"] == tracing.STATUS_ERROR
+        assert attributes(otlp)["exception.type"] == {"stringValue": "ValueError"}
+
+
+def test_export_drops_traces_when_queue_is_full(monkeypatch):
+    full_queue = queue.Queue(maxsize=1)
+    full_queue.put_nowait({})
+    monkeypatch.setattr(settings, "trace_export_path", "/tmp/unused.jsonl")
+    monkeypatch.setattr(tracing, "_export_queue", full_queue)
+    monkeypatch.setattr(tracing, "_dropped_traces", 0)
+
+    tracing.export_trace(tracing.Trace("rid"))
+    tracing.export_trace(tracing.Trace("rid"))
+
+    assert tracing._dropped_traces == 2
+    assert full_queue.qsize() == 1
+
+
+def test_shutdown_flushes_queued_traces(monkeypatch, tmp_path):
+    export_path = tmp_path / "traces.jsonl"
+    monkeypatch.setattr(settings, "trace_export_path", str(export_path))
+    monkeypatch.setattr(settings, "trace_collector_url", "")
+    # Пачка не отправится сама раньше, чем вызовется shutdown
+    monkeypatch.setattr(settings, "trace_export_interval", 60.0)
+
+    for index in range(3):
+        with tracing.request_trace("GET /test", f"rid-{index}"):
+            pass
+
+    assert tracing.shutdown(timeout=5.0)
+    lines = export_path.read_text(encoding="utf-8").splitlines()
+    assert len(lines) == 3
+    spans = json.loads(lines[0])["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    assert attributes(spans[0])["request.id"] == {"stringValue": "rid-0"}
+
+
+def test_shutdown_without_exporter():
+    assert tracing.shutdown(timeout=0.1)
+
+
+def test_middleware_echoes_request_id(client, exported):
+    response = client.get("/missing", headers={tracing.REQUEST_ID_HEADER: "client-id"})
+
+    assert response.status_code == 404
+    assert response.headers[tracing.REQUEST_ID_HEADER] == "client-id"
+    assert exported[0].request_id == "client-id"
+    assert exported[0].spans[0].to_otlp()["status"]["code"] == tracing.STATUS_OK
+
+
+def test_middleware_marks_5xx_as_error(client, exported, monkeypatch):
+    import main
+    from exceptions import ImageProcessingError
+
+    def fail(url):
+        raise ImageProcessingError("asset unavailable")
+
+    monkeypatch.setattr(main, "download_and_encode_image", fail)
+    response = client.get("/render-card", params={"name": "Имя", "text": "Текст"})
+
+    assert response.status_code == 500
+    request_id = response.headers[tracing.REQUEST_ID_HEADER]
+    root = exported[0].spans[0].to_otlp()
+    assert exported[0].request_id == request_id
+    assert root["status"] == {"code": tracing.STATUS_ERROR, "message": "HTTP 500"}
+    assert attributes(root)["http.status_code"] == {"intValue": "500"}